@@ -1,6 +1,18 @@
+import os
 import pathlib
 import sqlite3
-from typing import Any, Optional, TypedDict, Union
+from typing import Any, Dict, List, Optional, TypedDict, Union
+
+import numpy as np
+
+try:
+    import sqlite_vec
+except ImportError:
+    sqlite_vec = None
+
+
+def dequantize_vector(vector: bytes, scale: float) -> np.ndarray:
+    return np.frombuffer(vector, np.int8).astype(np.float32) * scale
 
 
 class ImageOmittable(TypedDict, total=False):
@@ -11,21 +23,92 @@ class NewImage(ImageOmittable):
     filepath: str
     modified_at: float
     size: int
-    vector: bytes
+    vector: np.ndarray
 
 
-class Image(NewImage):
+class Image(ImageOmittable):
     id: int
+    filepath: str
+    modified_at: float
+    size: int
+    row_index: int
 
 
 class DB:
-    VERSION = 1
+    VERSION = 3
+    FEATURES_INITIAL_CAPACITY = 1024
 
-    def __init__(self, filename: Union[str, pathlib.Path]):
+    def __init__(self, filename: Union[str, pathlib.Path], vector_size: int = 512):
         self._con = sqlite3.connect(filename)
         self._con.row_factory = sqlite3.Row
+        # WAL + NORMAL drops the fsync-per-commit cost during indexing while
+        # staying crash-safe; the rest trades memory for fewer disk reads
+        self._con.execute('PRAGMA journal_mode=WAL')
+        self._con.execute('PRAGMA synchronous=NORMAL')
+        self._con.execute('PRAGMA temp_store=MEMORY')
+        self._con.execute('PRAGMA mmap_size=1073741824')
+        self._con.execute('PRAGMA cache_size=-200000')
+        self._vector_size = vector_size
+        # the feature matrix lives next to the sqlite file as a memmapped .npy;
+        # sqlite rows only carry a row_index into it
+        self._features_path = pathlib.Path(filename).with_name('features.npy')
+        self._features: Optional[np.ndarray] = None
+        self._next_row_index: Optional[int] = None
+        self.vec_enabled = self._try_load_vec_extension()
         self.ensure_tables()
         self.ensure_version()
+        self.ensure_vec_table()
+
+    @property
+    def features(self) -> np.ndarray:
+        if self._features is None:
+            if self._features_path.exists():
+                self._features = np.lib.format.open_memmap(self._features_path, mode='r+')
+            else:
+                # size a fresh file to cover any row_index already in sqlite, so a
+                # deleted .npy degrades to zero vectors instead of index errors
+                try:
+                    row = self._con.execute('SELECT MAX(row_index) AS max_index FROM images').fetchone()
+                    used_rows = 0 if row['max_index'] is None else row['max_index'] + 1
+                except sqlite3.OperationalError:
+                    # pre-v3 schema, still being migrated
+                    used_rows = 0
+                self._features = np.lib.format.open_memmap(
+                    self._features_path, mode='w+', dtype=np.float32,
+                    shape=(max(self.FEATURES_INITIAL_CAPACITY, used_rows), self._vector_size)
+                )
+        return self._features
+
+    def _allocate_feature_row(self) -> int:
+        if self._next_row_index is None:
+            row = self._con.execute('SELECT MAX(row_index) AS max_index FROM images').fetchone()
+            self._next_row_index = 0 if row['max_index'] is None else row['max_index'] + 1
+        row_index = self._next_row_index
+        if row_index >= self.features.shape[0]:
+            self._grow_features(max(self.features.shape[0] * 2, row_index + 1))
+        self._next_row_index += 1
+        return row_index
+
+    def _grow_features(self, capacity: int):
+        old = self.features
+        grown = np.lib.format.open_memmap(
+            self._features_path.with_suffix('.grow.npy'), mode='w+',
+            dtype=np.float32, shape=(capacity, self._vector_size)
+        )
+        grown[:old.shape[0]] = old[:]
+        os.replace(self._features_path.with_suffix('.grow.npy'), self._features_path)
+        self._features = grown
+
+    def _try_load_vec_extension(self) -> bool:
+        if sqlite_vec is None:
+            return False
+        try:
+            self._con.enable_load_extension(True)
+            sqlite_vec.load(self._con)
+            self._con.enable_load_extension(False)
+        except (AttributeError, sqlite3.OperationalError):
+            return False
+        return True
 
     def ensure_tables(self):
         self._con.execute('''
@@ -35,7 +118,7 @@ class DB:
         filepath TEXT NOT NULL UNIQUE,
         modified_at DATETIME NOT NULL,
         size INTEGER NOT NULL,
-        vector BLOB NOT NULL
+        row_index INTEGER NOT NULL
       )
     ''')
         # Query for images
@@ -43,6 +126,9 @@ class DB:
 
         self._con.execute('CREATE TABLE IF NOT EXISTS db_version (version INTEGER)')
 
+        # last successfully scanned mtime per directory, to skip unchanged ones
+        self._con.execute('CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, last_scanned REAL NOT NULL)')
+
         self._con.commit()
 
     def ensure_version(self):
@@ -51,41 +137,195 @@ class DB:
             self._con.execute('INSERT INTO db_version(version) VALUES (?)', (self.VERSION,))
             self._con.commit()
         elif db_version['version'] < self.VERSION:
-            raise Exception('migration to a newer index version isn\'t implemented')
+            self.migrate(db_version['version'])
         elif db_version['version'] > self.VERSION:
             raise Exception(
                 'found index version newer than this version of rclip can support;'
                 ' please, update rclip: https://github.com/yurijmikhalevich/rclip/releases'
             )
 
+    def migrate(self, from_version: int):
+        if from_version < 3:
+            # versions 1 and 2 stored vectors as blobs on the images table
+            # (float32 and int8 + scale respectively); move them into the
+            # memmapped feature matrix and keep only a row_index in sqlite
+            has_scale = 'scale' in [row['name'] for row in self._con.execute('PRAGMA table_info(images)')]
+            self._con.execute('''
+        CREATE TABLE images_v3 (
+          id INTEGER PRIMARY KEY,
+          deleted BOOLEAN,
+          filepath TEXT NOT NULL UNIQUE,
+          modified_at DATETIME NOT NULL,
+          size INTEGER NOT NULL,
+          row_index INTEGER NOT NULL
+        )
+      ''')
+            # the old images table has no row_index column to count from
+            self._next_row_index = 0
+            for row in self._con.execute('SELECT * FROM images ORDER BY id').fetchall():
+                if has_scale and row['scale'] is not None:
+                    vector = dequantize_vector(row['vector'], row['scale'])
+                else:
+                    vector = np.frombuffer(row['vector'], np.float32)
+                row_index = self._allocate_feature_row()
+                self.features[row_index] = vector
+                self._con.execute(
+                    'INSERT INTO images_v3(id, deleted, filepath, modified_at, size, row_index)'
+                    ' VALUES (?, ?, ?, ?, ?, ?)',
+                    (row['id'], row['deleted'], row['filepath'], row['modified_at'], row['size'], row_index)
+                )
+            self._con.execute('DROP TABLE images')
+            self._con.execute('ALTER TABLE images_v3 RENAME TO images')
+            self._con.execute(
+                'CREATE UNIQUE INDEX IF NOT EXISTS existing_images ON images(filepath) WHERE deleted IS NULL'
+            )
+            self.features.flush()
+        self._con.execute('UPDATE db_version SET version = ?', (self.VERSION,))
+        self._con.commit()
+
+    def ensure_vec_table(self):
+        if not self.vec_enabled:
+            return
+        self._con.execute(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS vec_images'
+            f' USING vec0(embedding FLOAT[{self._vector_size}] distance_metric=cosine)'
+        )
+        # backfill vectors indexed before the extension became available
+        # (or purged while their image was flagged deleted)
+        missing = self._con.execute(
+            'SELECT id, row_index FROM images'
+            ' WHERE deleted IS NULL AND id NOT IN (SELECT rowid FROM vec_images)'
+        ).fetchall()
+        for row in missing:
+            self._con.execute('INSERT INTO vec_images(rowid, embedding) VALUES (?, ?)',
+                              (row['id'], self.features[row['row_index']].tobytes()))
+        self._con.commit()
+
+    def count_vec_images(self) -> int:
+        return self._con.execute('SELECT COUNT(*) AS count FROM vec_images').fetchone()['count']
+
+    def purge_deleted_vec_images(self, commit=True):
+        # vectors of deleted images would otherwise keep consuming KNN slots
+        if not self.vec_enabled:
+            return
+        self._con.execute('DELETE FROM vec_images WHERE rowid IN (SELECT id FROM images WHERE deleted IS NOT NULL)')
+        if commit:
+            self._con.commit()
+
+    def begin(self):
+        self._con.execute('BEGIN IMMEDIATE')
+
     def commit(self):
+        if self._features is not None:
+            self._features.flush()
         self._con.commit()
 
     def upsert_image(self, image: NewImage, commit=True):
+        vector = np.asarray(image['vector'], np.float32)
+        existing = self._con.execute(
+            'SELECT id, row_index FROM images WHERE filepath = ?', (image['filepath'],)
+        ).fetchone()
+        # an updated image keeps its feature row; a new one gets the next slot
+        row_index = existing['row_index'] if existing else self._allocate_feature_row()
+        self.features[row_index] = vector
         self._con.execute('''
-      INSERT INTO images(deleted, filepath, modified_at, size, vector)
-      VALUES (:deleted, :filepath, :modified_at, :size, :vector)
+      INSERT INTO images(deleted, filepath, modified_at, size, row_index)
+      VALUES (:deleted, :filepath, :modified_at, :size, :row_index)
       ON CONFLICT(filepath) DO UPDATE SET
-        deleted=:deleted, modified_at=:modified_at, size=:size, vector=:vector
-    ''', {'deleted': None, **image})
+        deleted=:deleted, modified_at=:modified_at, size=:size, row_index=:row_index
+    ''', {'deleted': None, 'filepath': image['filepath'], 'modified_at': image['modified_at'],
+          'size': image['size'], 'row_index': row_index})
+        if self.vec_enabled:
+            image_id = existing['id'] if existing else self._con.execute(
+                'SELECT id FROM images WHERE filepath = ?', (image['filepath'],)
+            ).fetchone()['id']
+            self._con.execute('DELETE FROM vec_images WHERE rowid = ?', (image_id,))
+            self._con.execute('INSERT INTO vec_images(rowid, embedding) VALUES (?, ?)',
+                              (image_id, vector.tobytes()))
         if commit:
             self._con.commit()
 
-    def flag_images_in_a_dir_as_deleted(self, path: str):
-        self._con.execute('UPDATE images SET deleted = 1 WHERE filepath LIKE ?', (path + '/%',))
-        self._con.commit()
+    # deleted flag values: 1 means the image is known to be gone, 2 marks rows
+    # flagged by the index pass currently underway; the pass clears 2 back to
+    # NULL for every image it finds and finalizes the leftovers to 1, so bulk
+    # unflags can't resurrect images deleted by an earlier pass
+
+    def flag_images_in_a_dir_as_deleted(self, path: str, commit=True):
+        self._con.execute('UPDATE images SET deleted = 2 WHERE filepath LIKE ? AND deleted IS NULL', (path + '/%',))
+        if commit:
+            self._con.commit()
 
     def remove_deleted_flag(self, filepath: str, commit=True):
         self._con.execute('UPDATE images SET deleted = NULL WHERE filepath = ?', (filepath,))
         if commit:
             self._con.commit()
 
+    def remove_deleted_flag_for_dir(self, path: str, commit=True):
+        # only rows flagged by this pass, and only the files directly in the
+        # dir; subdirs are tracked by their own rows
+        self._con.execute(
+            'UPDATE images SET deleted = NULL WHERE deleted = 2 AND filepath LIKE ? AND filepath NOT LIKE ?',
+            (path + '/%', path + '/%/%')
+        )
+        if commit:
+            self._con.commit()
+
+    def finalize_deleted_flags(self, path: str, commit=True):
+        self._con.execute('UPDATE images SET deleted = 1 WHERE deleted = 2 AND filepath LIKE ?', (path + '/%',))
+        if commit:
+            self._con.commit()
+
+    def get_dir_scan_times(self) -> Dict[str, float]:
+        return {row['path']: row['last_scanned'] for row in self._con.execute('SELECT path, last_scanned FROM dirs')}
+
+    def delete_dir_scan_time(self, path: str, commit=True):
+        self._con.execute('DELETE FROM dirs WHERE path = ?', (path,))
+        if commit:
+            self._con.commit()
+
+    def upsert_dir_scan_time(self, path: str, last_scanned: float, commit=True):
+        self._con.execute('''
+      INSERT INTO dirs(path, last_scanned) VALUES (:path, :last_scanned)
+      ON CONFLICT(path) DO UPDATE SET last_scanned=:last_scanned
+    ''', {'path': path, 'last_scanned': last_scanned})
+        if commit:
+            self._con.commit()
+
     def get_image(self, **kwargs: Any) -> Optional[Image]:
         query = ' AND '.join(f'{key}=:{key}' for key in kwargs)
         cur = self._con.execute(f'SELECT * FROM images WHERE {query} LIMIT 1', kwargs)
         return cur.fetchone()
 
-    def get_image_vectors_by_dir_path(self, path: str) -> sqlite3.Cursor:
-        return self._con.execute(
-            f'SELECT filepath, vector FROM images WHERE filepath LIKE ? AND deleted IS NULL', (path + '/%',)
-        )
+    def get_images_by_paths(self, paths: List[str]) -> Dict[str, Image]:
+        images: Dict[str, Image] = {}
+        # chunked to stay under SQLITE_MAX_VARIABLE_NUMBER
+        for offset in range(0, len(paths), 500):
+            chunk = paths[offset:offset + 500]
+            placeholders = ','.join('?' * len(chunk))
+            for row in self._con.execute(f'SELECT * FROM images WHERE filepath IN ({placeholders})', chunk):
+                images[row['filepath']] = row
+        return images
+
+    def get_image_rows_by_dir_path(self, path: str,
+                                   exclude_patterns: Optional[List[str]] = None) -> sqlite3.Cursor:
+        query = 'SELECT filepath, row_index FROM images WHERE filepath LIKE ? AND deleted IS NULL'
+        params: List[Any] = [path + '/%']
+        for pattern in exclude_patterns or []:
+            query += " AND filepath NOT LIKE ? ESCAPE '\\'"
+            params.append(pattern)
+        return self._con.execute(query, params)
+
+    def get_nearest_images_by_vector(self, embedding: bytes, path: str, k: int,
+                                     exclude_patterns: Optional[List[str]] = None) -> sqlite3.Cursor:
+        params: Any = {'embedding': embedding, 'k': k, 'path': path + '/%'}
+        exclude_sql = ''
+        for i, pattern in enumerate(exclude_patterns or []):
+            exclude_sql += f" AND images.filepath NOT LIKE :exclude{i} ESCAPE '\\'"
+            params[f'exclude{i}'] = pattern
+        return self._con.execute(f'''
+      SELECT images.filepath AS filepath, knn.distance AS distance
+      FROM (SELECT rowid, distance FROM vec_images WHERE embedding MATCH :embedding AND k = :k) knn
+      JOIN images ON images.id = knn.rowid
+      WHERE images.filepath LIKE :path AND images.deleted IS NULL{exclude_sql}
+      ORDER BY knn.distance
+    ''', params)
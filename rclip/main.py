@@ -1,10 +1,8 @@
-import itertools
+import concurrent.futures
 import os
-from os import path
 import re
-from typing import Iterable, List, NamedTuple, Optional, Tuple, TypedDict, cast
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple, TypedDict, cast
 import subprocess
-from pathlib import Path
 
 import numpy as np
 from matplotlib import pyplot as plt
@@ -22,11 +20,13 @@ class ImageMeta(TypedDict):
     size: int
 
 
-def get_image_meta(filepath: str) -> ImageMeta:
-    return ImageMeta(
-        modified_at=os.path.getmtime(filepath),
-        size=os.path.getsize(filepath)
-    )
+def try_stat_image_meta(entry: 'os.DirEntry[str]') -> Optional[ImageMeta]:
+    try:
+        stat = entry.stat()
+        return ImageMeta(modified_at=stat.st_mtime, size=stat.st_size)
+    except OSError as ex:
+        print(f'error getting fs metadata for {entry.path}:', ex)
+        return None
 
 
 def is_image_meta_equal(image: db.Image, meta: ImageMeta) -> bool:
@@ -36,116 +36,217 @@ def is_image_meta_equal(image: db.Image, meta: ImageMeta) -> bool:
     return True
 
 
+class DecodedBatch(NamedTuple):
+    filepaths: List[str]
+    metas: List[ImageMeta]
+    tensors: List[Any]
+
+
 class RClip:
     EXCLUDE_DIRS_DEFAULT = ['@eaDir', 'node_modules', '.git']
-    IMAGE_REGEX = re.compile(r'^.+\.(jpe?g|png)$', re.I)
-    BATCH_SIZE = 8
-    DB_IMAGES_BEFORE_COMMIT = 50_000
+    IMAGE_SUFFIXES = ('.jpg', '.jpeg', '.png')
+    # bigger batches keep a CUDA device busy; on CPU they only grow memory use
+    BATCH_SIZE_CPU = 8
+    BATCH_SIZE_CUDA = 64
+    # stat calls are latency-bound on network filesystems; overlap them
+    INDEX_STAT_WORKERS = 32
 
     class SearchResult(NamedTuple):
         filepath: str
         score: float
 
-    def __init__(self, model_instance: model.Model, database: db.DB, exclude_dirs: Optional[List[str]]):
+    def __init__(self, model_instance: model.Model, database: db.DB, exclude_dirs: Optional[List[str]],
+                 batch_size: Optional[int] = None):
         self._model = model_instance
         self._db = database
+        if batch_size is None:
+            batch_size = self.BATCH_SIZE_CUDA if model_instance.is_cuda else self.BATCH_SIZE_CPU
+        self._batch_size = batch_size
 
-        excluded_dirs = '|'.join(re.escape(dir) for dir in exclude_dirs or self.EXCLUDE_DIRS_DEFAULT)
+        exclude_dirs = exclude_dirs or self.EXCLUDE_DIRS_DEFAULT
+        excluded_dirs = '|'.join(re.escape(dir) for dir in exclude_dirs)
         self._exclude_dir_regex = re.compile(f'^.+\\/({excluded_dirs})(\\/.+)?$')
-
-    def _index_files(self, filepaths: List[str], metas: List[ImageMeta]):
-        images: List[Image.Image] = []
-        filtered_paths: List[str] = []
-        for path in filepaths:
+        # same exclusions as LIKE patterns, so queries can filter inside sqlite
+        self._exclude_dir_patterns = [
+            '%/' + dir.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '/%'
+            for dir in exclude_dirs
+        ]
+
+    def _decode_batch(self, filepaths: List[str], metas: List[ImageMeta]) -> DecodedBatch:
+        # runs on the decode thread; only preprocessed tensors cross back
+        tensors = []
+        decoded_paths: List[str] = []
+        decoded_metas: List[ImageMeta] = []
+        for path, meta in zip(filepaths, metas):
             try:
                 image = Image.open(path)
-                images.append(image)
-                filtered_paths.append(path)
+                # ask libjpeg to decode at reduced resolution (no-op for png);
+                # 2x the model input keeps the preprocess resize well sampled
+                image.draft('RGB', (model.Model.INPUT_SIZE * 2, model.Model.INPUT_SIZE * 2))
+                tensors.append(self._model.preprocess_image(image))
+                decoded_paths.append(path)
+                decoded_metas.append(meta)
             except PIL.UnidentifiedImageError as ex:
-                pass
+                # could just as well be a file caught mid-copy; retry its dir
+                self._index_failed_dirs.add(os.path.dirname(path))
             except Exception as ex:
                 print(f'error loading image {path}:', ex)
+                self._index_failed_dirs.add(os.path.dirname(path))
+        return DecodedBatch(filepaths=decoded_paths, metas=decoded_metas, tensors=tensors)
 
+    def _index_files(self, decoded: DecodedBatch):
+        if not decoded.tensors:
+            return
         try:
-            features = self._model.compute_image_features(images)
+            features = self._model.compute_image_features_preprocessed(decoded.tensors, pad_to=self._batch_size)
         except Exception as ex:
             print('error computing features:', ex)
+            # make sure the next run retries these dirs instead of skipping them
+            self._index_failed_dirs.update(os.path.dirname(filepath) for filepath in decoded.filepaths)
             return
         for path, meta, vector in cast(Iterable[Tuple[str, ImageMeta, np.ndarray]],
-                                       zip(filtered_paths, metas, features)):
+                                       zip(decoded.filepaths, decoded.metas, features)):
             self._db.upsert_image(db.NewImage(
                 filepath=path,
                 modified_at=meta['modified_at'],
                 size=meta['size'],
-                vector=vector.tobytes()
+                vector=vector
             ), commit=False)
 
+    def _walk_images(self, directory: str, executor: concurrent.futures.Executor,
+                     dir_scan_times: Dict[str, float]
+                     ) -> Iterable[Tuple[str, Optional[List[Tuple[str, Optional[ImageMeta]]]], float]]:
+        # scandir-based walk: one readdir per directory and one stat per image
+        # entry (fanned out on the executor), pruning excluded subtrees early;
+        # dirs whose mtime hasn't moved since their last successful scan are
+        # yielded without entries so the caller can skip them wholesale
+        try:
+            dir_mtime = os.stat(directory).st_mtime
+        except OSError:
+            return
+        subdirs: List[str] = []
+        image_entries: List['os.DirEntry[str]'] = []
+        try:
+            with os.scandir(directory) as dir_entries:
+                for entry in dir_entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif entry.name.lower().endswith(self.IMAGE_SUFFIXES):
+                        image_entries.append(entry)
+        except OSError:
+            # unreadable dirs are skipped, like os.walk did
+            return
+        if image_entries:
+            if dir_scan_times.get(directory, float('-inf')) >= dir_mtime:
+                yield directory, None, dir_mtime
+            else:
+                metas = executor.map(try_stat_image_meta, image_entries)
+                yield directory, [(entry.path, meta) for entry, meta in zip(image_entries, metas)], dir_mtime
+        for subdir in subdirs:
+            if not self._exclude_dir_regex.match(subdir):
+                yield from self._walk_images(subdir, executor, dir_scan_times)
+
     def ensure_index(self, directory: str):
+        # the whole pass runs in one transaction: WAL keeps readers unblocked
+        # and a crash leaves the previous index untouched
+        self._db.begin()
         # We will mark existing images as existing later
-        self._db.flag_images_in_a_dir_as_deleted(directory)
+        self._db.flag_images_in_a_dir_as_deleted(directory, commit=False)
 
-        images_processed = 0
         batch: List[str] = []
         metas: List[ImageMeta] = []
-        for root, _, files in os.walk(directory):
-            if self._exclude_dir_regex.match(root):
-                continue
-            filtered_files = list(f for f in files if self.IMAGE_REGEX.match(f))
-            if not filtered_files:
-                continue
-            for file in cast(Iterable[str], tqdm(filtered_files, desc=root)):
-                filepath = path.join(root, file)
-
-                image = self._db.get_image(filepath=filepath)
-                try:
-                    meta = get_image_meta(filepath)
-                except Exception as ex:
-                    print(f'error getting fs metadata for {filepath}:', ex)
+        self._index_failed_dirs: 'set[str]' = set()
+        # one decode worker keeps a single batch in flight: it decodes and
+        # preprocesses batch N+1 while the model runs inference on batch N
+        pending: Optional['concurrent.futures.Future[DecodedBatch]'] = None
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.INDEX_STAT_WORKERS) as executor, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=1) as decode_executor:
+            dir_scan_times = self._db.get_dir_scan_times()
+            for root, entries, dir_mtime in self._walk_images(directory, executor, dir_scan_times):
+                if entries is None:
+                    # unchanged since its last scan; keep its files undeleted
+                    self._db.remove_deleted_flag_for_dir(root, commit=False)
                     continue
-
-                if not images_processed % self.DB_IMAGES_BEFORE_COMMIT:
-                    self._db.commit()
-                images_processed += 1
-
-                if image and is_image_meta_equal(image, meta):
-                    self._db.remove_deleted_flag(filepath, commit=False)
-                    continue
-
-                batch.append(filepath)
-                metas.append(meta)
-
-                if len(batch) >= self.BATCH_SIZE:
-                    self._index_files(batch, metas)
-                    batch = []
-                    metas = []
-
-        if len(batch) != 0:
-            self._index_files(batch, metas)
+                # one query per directory instead of one get_image round trip per file
+                existing_images = self._db.get_images_by_paths([filepath for filepath, _ in entries])
+                for filepath, meta in cast(Iterable[Tuple[str, Optional[ImageMeta]]], tqdm(entries, desc=root)):
+                    if meta is None:
+                        # a file we couldn't stat must be retried next run
+                        self._index_failed_dirs.add(root)
+                        continue
+
+                    image = existing_images.get(filepath)
+
+                    if image and is_image_meta_equal(image, meta):
+                        self._db.remove_deleted_flag(filepath, commit=False)
+                        continue
+
+                    batch.append(filepath)
+                    metas.append(meta)
+
+                    if len(batch) >= self._batch_size:
+                        # submit the new batch before draining the previous one,
+                        # so its decode runs while the model is busy below
+                        new_pending = decode_executor.submit(self._decode_batch, batch, metas)
+                        if pending is not None:
+                            self._index_files(pending.result())
+                        pending = new_pending
+                        batch = []
+                        metas = []
+
+                # rolled back with everything else if the run doesn't finish
+                self._db.upsert_dir_scan_time(root, dir_mtime, commit=False)
+
+            if pending is not None:
+                self._index_files(pending.result())
+            if len(batch) != 0:
+                self._index_files(self._decode_batch(batch, metas))
+
+        for failed_dir in self._index_failed_dirs:
+            self._db.delete_dir_scan_time(failed_dir, commit=False)
+
+        self._db.finalize_deleted_flags(directory, commit=False)
+        self._db.purge_deleted_vec_images(commit=False)
 
         self._db.commit()
 
     def search(self, query: str, directory: str, top_k: int = 10) -> List[SearchResult]:
-        filepaths, features = self._get_features(directory)
+        if self._db.vec_enabled:
+            return self._search_vec(query, directory, top_k)
 
-        sorted_similarities = self._model.compute_similarities_to_text(features, query)
+        filepaths, features = self._get_features(directory)
 
-        filtered_similarities = filter(
-            lambda similarity: not self._exclude_dir_regex.match(filepaths[similarity[1]]),
-            sorted_similarities
-        )
-        top_k_similarities = itertools.islice(filtered_similarities, top_k)
+        # excluded dirs are already filtered out inside sqlite
+        top_k_similarities = self._model.compute_similarities_to_text(features, query, top_k)
 
         return [RClip.SearchResult(filepath=filepaths[th[1]], score=th[0]) for th in top_k_similarities]
 
+    def _search_vec(self, query: str, directory: str, top_k: int) -> List[SearchResult]:
+        # the KNN runs over every stored vector and the directory/exclude
+        # filters only apply to the join afterwards, so grow k until top_k
+        # rows survive or the fetch covers the whole table (making the
+        # result exact even for heavily filtered directories)
+        text_features = self._model.compute_text_features(query)
+        embedding = text_features[0].astype(np.float32).tobytes()
+
+        total = self._db.count_vec_images()
+        fetch_k = top_k * 4
+        while True:
+            rows = self._db.get_nearest_images_by_vector(
+                embedding, directory, fetch_k, self._exclude_dir_patterns).fetchall()
+            if len(rows) >= top_k or fetch_k >= total:
+                break
+            fetch_k *= 4
+
+        return [RClip.SearchResult(filepath=row['filepath'], score=1 - row['distance'])
+                for row in rows[:top_k]]
+
     def _get_features(self, directory: str) -> Tuple[List[str], np.ndarray]:
-        filepaths: List[str] = []
-        features: List[np.ndarray] = []
-        for image in self._db.get_image_vectors_by_dir_path(directory):
-            filepaths.append(image['filepath'])
-            features.append(np.frombuffer(image['vector'], np.float32))
-        if not filepaths:
-            return [], np.ndarray(shape=(0, model.Model.VECTOR_SIZE))
-        return filepaths, np.stack(features)
+        rows = self._db.get_image_rows_by_dir_path(directory, self._exclude_dir_patterns).fetchall()
+        filepaths = [image['filepath'] for image in rows]
+        # gather only the requested rows straight out of the memmapped matrix
+        row_indices = [image['row_index'] for image in rows]
+        return filepaths, self._db.features[row_indices]
 
 
 def main():
@@ -157,7 +258,7 @@ def main():
 
     model_instance = model.Model()
     datadir = utils.get_app_datadir()
-    database = db.DB(datadir / 'db.sqlite3')
+    database = db.DB(datadir / 'db.sqlite3', vector_size=model.Model.VECTOR_SIZE)
     rclip = RClip(model_instance, database, args.exclude_dir)
 
     truncated_query = args.query[:141] # maximum limit for ecryptfs filenames/paths
@@ -189,16 +290,19 @@ def main():
     proc = subprocess.Popen(['feh', '-t', '-f', './results/'+args.query+'/topn', '--no-screen-clip', '-E 200', '-y 200', '-d'])
 
 
-    # plot similarities
+    # plot similarities; decode the thumbnails and compute the cluster breaks
+    # once, all three figures reuse them
+
+    top_thumbs = [utils.load_scatter_thumbnail(p) for p in top_paths]
+    breaks = utils.get_jenks_breaks(top_similarities, 3)
 
-    fig1 = utils.scatterImage(top_paths, top_similarities, zoom=0.12, size=(20, 5))
+    fig1, fig3, fig2 = utils.scatterImages(top_thumbs, top_similarities, breaks,
+                                           [(0.12, (20, 5)), (0.06, (20, 5)), (0.08, (7, 12))])
     plt.ioff()
     fig1.savefig(os.path.join(results_dir, 'results.svg'), dpi=fig1.dpi)
 
-    fig3 = utils.scatterImage(top_paths, top_similarities, zoom=0.06, size=(20, 5))
     fig3.savefig(os.path.join(results_dir, 'results_zoomed.svg'), dpi=fig1.dpi)
 
-    fig2 = utils.scatterImage(top_paths, top_similarities, zoom=0.08, size=(7, 12))
     # don't show:
     plt.close(fig3); plt.close(fig1)
     plt.show()
@@ -1,4 +1,4 @@
-from typing import Callable, List, Tuple, cast
+from typing import Callable, List, Optional, Tuple, cast
 
 import clip
 import clip.model
@@ -10,25 +10,73 @@ import torch.nn
 
 class Model:
     VECTOR_SIZE = 512
-    _device = 'cpu'
+    INPUT_SIZE = 224
     _model_name = 'ViT-B/32'
 
     def __init__(self):
+        self._device = 'cuda' if torch.cuda.is_available() else 'cpu'
         model, preprocess = cast(
             Tuple[clip.model.CLIP, Callable[[Image.Image], torch.Tensor]],
             clip.load(self._model_name, device=self._device)
         )
         self._model = model
         self._preprocess = preprocess
+        self._pinned_batch: Optional[torch.Tensor] = None
+        self._eager_encode_image = model.encode_image
+        self._encode_image = self._eager_encode_image
+        # torch >= 2 can fuse the eager per-op dispatch away; combined with
+        # fixed-shape batches this also enables CUDA graphs
+        if hasattr(torch, 'compile'):
+            try:
+                self._encode_image = torch.compile(self._eager_encode_image, mode='reduce-overhead')
+            except Exception as ex:
+                print('torch.compile unavailable, running eager:', ex)
 
-    def compute_image_features(self, images: List[Image.Image]) -> np.ndarray:
-        images_preprocessed = torch.stack([self._preprocess(thumb) for thumb in images]).to(self._device)
+    @property
+    def is_cuda(self) -> bool:
+        return self._device == 'cuda'
+
+    def _stack_batch(self, tensors: List[torch.Tensor]) -> torch.Tensor:
+        if not self.is_cuda:
+            return torch.stack(tensors).to(self._device)
+        # stage the batch in pinned host memory so the copy to the device is async
+        if self._pinned_batch is None or self._pinned_batch.shape[0] < len(tensors):
+            self._pinned_batch = torch.empty((len(tensors), *tensors[0].shape), pin_memory=True)
+        batch = torch.stack(tensors, out=self._pinned_batch[:len(tensors)])
+        return batch.to(self._device, non_blocking=True)
+
+    def preprocess_image(self, image: Image.Image) -> torch.Tensor:
+        return self._preprocess(image)
+
+    def compute_image_features_preprocessed(self, tensors: List[torch.Tensor],
+                                            pad_to: Optional[int] = None) -> np.ndarray:
+        # padding every batch to the same size keeps the compiled graph shape
+        # fixed; the padded rows are trimmed from the result
+        count = len(tensors)
+        if pad_to is not None and count < pad_to:
+            tensors = tensors + [tensors[-1]] * (pad_to - count)
+        images_preprocessed = self._stack_batch(tensors)
 
         with torch.no_grad():
-            image_features = self._model.encode_image(images_preprocessed)
+            try:
+                image_features = self._encode_image(images_preprocessed)
+            except Exception as ex:
+                if self._encode_image is self._eager_encode_image:
+                    raise
+                # torch.compile is lazy: backend failures (no triton, no C++
+                # toolchain) only surface on the first call, so fall back to
+                # eager for good instead of erroring on every batch
+                print('compiled image encoder failed, falling back to eager:', ex)
+                self._encode_image = self._eager_encode_image
+                image_features = self._encode_image(images_preprocessed)
+            # normalized once here, before the vectors are stored; the search
+            # path relies on this and never renormalizes the feature matrix
             image_features /= image_features.norm(dim=-1, keepdim=True)
 
-        return image_features.cpu().numpy()
+        return image_features.cpu().numpy()[:count]
+
+    def compute_image_features(self, images: List[Image.Image]) -> np.ndarray:
+        return self.compute_image_features_preprocessed([self._preprocess(thumb) for thumb in images])
 
     def compute_text_features(self, text: str) -> np.ndarray:
         with torch.no_grad():
@@ -37,10 +85,16 @@ class Model:
 
         return text_encoded.cpu().numpy()
 
-    def compute_similarities_to_text(self, item_features: np.ndarray, text: str) -> List[Tuple[float, int]]:
+    def compute_similarities_to_text(self, item_features: np.ndarray, text: str,
+                                     top_k: Optional[int] = None) -> List[Tuple[float, int]]:
         text_features = self.compute_text_features(text)
 
-        similarities = (text_features @ item_features.T).squeeze(0).tolist()
-        sorted_similarities = sorted(zip(similarities, range(item_features.shape[0])), key=lambda x: x[0], reverse=True)
+        scores = (text_features @ item_features.T).squeeze(0)
+        if top_k is not None and top_k < scores.shape[0]:
+            # pick the top_k in O(n) and sort only those instead of all scores
+            idx = np.argpartition(scores, -top_k)[-top_k:]
+        else:
+            idx = np.arange(scores.shape[0])
+        idx = idx[np.argsort(scores[idx])[::-1]]
 
-        return sorted_similarities
+        return [(float(scores[i]), int(i)) for i in idx]
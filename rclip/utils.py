@@ -1,8 +1,11 @@
 import argparse
+import copy
 import os
 import pathlib
 import sys
 
+import numpy as np
+from PIL import Image
 from matplotlib import ticker
 
 import config
@@ -10,81 +13,95 @@ import config
 import matplotlib.pyplot as plt
 from matplotlib.offsetbox import OffsetImage, AnnotationBbox
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 
-def scatterImage(paths, similarities, zoom=0.03, jenks_breaks=3, size=(50,50)):
-    fig, ax = plt.subplots(figsize=size)
 
-    x, y = list(range(0, len(similarities))), similarities
+def load_scatter_thumbnail(path, max_size=256):
+    '''
+    Decodes an image once at thumbnail resolution and returns the pixel array
+    together with the downscale factor, so OffsetImage zooms can be corrected
+    to render at the same size as the full image would.
+    '''
+    image = Image.open(path)
+    original_width = image.width
+    image.draft('RGB', (max_size, max_size))
+    image.thumbnail((max_size, max_size), Image.BILINEAR)
+    return np.asarray(image.convert('RGB')), original_width / image.width
 
-    ax.scatter(x, y)
-
-    for x0, y0, path in zip(reversed(x), reversed(y), reversed(paths)):
-        ab = AnnotationBbox(
-            OffsetImage(plt.imread(path), zoom=zoom),
-            (
-                x0,
-                y0
-                #y0 + (y[0]-y[-1]) / (len(similarities)/(zoom*75)) # shift images above dots
-             ),
-            frameon=False
-        )
-        ax.add_artist(ab)
-
-    if jenks_breaks > 0:
-        breaks = get_jenks_breaks(data_list=similarities, number_classes=jenks_breaks)
-
-    ax.set_ylabel('Similarity', rotation=90)
-    ax.set_xlabel('Images')
-
-    ax2 = ax.twinx()
-    ax2.set_ylabel('Cluster', rotation=90)
-    ax2.set_ylim(ax.get_ylim())
-    ax2.yaxis.set_ticks(breaks)
-    #ax2.xaxis.set_major_formatter(ticker.FormatStrFormatter('%.2f'))
-    #ax2.tick_params(axis='y', rotation=90)
-
-    for i, line in enumerate(breaks):
-        #ax.plot([line for _ in range(len(similarities))], 'k')
-        plt.axhline(line, color='k', linestyle='-')
-        #pos = len(similarities) if i > len(similarities)//2 else len(similarities)//10
-        #plt.text(pos, line, f'cluster {i}', fontsize=30, va='center', ha='center', backgroundcolor='w')
-
-    plt.tight_layout()
-    return fig
 
-# https://stackoverflow.com/questions/28416408/scikit-learn-how-to-run-kmeans-on-a-one-dimensional-array
-def get_jenks_breaks(data_list, number_classes):
-    data_list = data_list.copy()
-
-    data_list.sort()
-    mat1 = []
-    for i in range(len(data_list) + 1):
-        temp = []
-        for j in range(number_classes + 1):
-            temp.append(0)
-        mat1.append(temp)
-    mat2 = []
-    for i in range(len(data_list) + 1):
-        temp = []
-        for j in range(number_classes + 1):
-            temp.append(0)
-        mat2.append(temp)
+def scatterImages(thumbs, similarities, breaks, specs):
+    '''
+    Builds one figure per (zoom, size) spec in a single pass. The OffsetImage
+    artists are constructed once per zoom level and shallow-copied into each
+    figure, so every figure shares the same underlying pixel arrays.
+    '''
+    x, y = list(range(0, len(similarities))), similarities
+
+    offset_images = {}
+    figs = []
+    for zoom, size in specs:
+        fig, ax = plt.subplots(figsize=size)
+
+        ax.scatter(x, y)
+
+        if zoom not in offset_images:
+            offset_images[zoom] = [OffsetImage(thumb, zoom=zoom * thumb_scale) for thumb, thumb_scale in thumbs]
+        for x0, y0, offset_image in zip(reversed(x), reversed(y), reversed(offset_images[zoom])):
+            ab = AnnotationBbox(
+                copy.copy(offset_image),
+                (
+                    x0,
+                    y0
+                    #y0 + (y[0]-y[-1]) / (len(similarities)/(zoom*75)) # shift images above dots
+                 ),
+                frameon=False
+            )
+            ax.add_artist(ab)
+
+        ax.set_ylabel('Similarity', rotation=90)
+        ax.set_xlabel('Images')
+
+        ax2 = ax.twinx()
+        ax2.set_ylabel('Cluster', rotation=90)
+        ax2.set_ylim(ax.get_ylim())
+        ax2.yaxis.set_ticks(breaks)
+        #ax2.xaxis.set_major_formatter(ticker.FormatStrFormatter('%.2f'))
+        #ax2.tick_params(axis='y', rotation=90)
+
+        for i, line in enumerate(breaks):
+            #ax.plot([line for _ in range(len(similarities))], 'k')
+            ax.axhline(line, color='k', linestyle='-')
+            #pos = len(similarities) if i > len(similarities)//2 else len(similarities)//10
+            #plt.text(pos, line, f'cluster {i}', fontsize=30, va='center', ha='center', backgroundcolor='w')
+
+        fig.tight_layout()
+        figs.append(fig)
+    return figs
+
+def _jenks_breaks_impl(data, number_classes):
+    n = data.shape[0]
+    mat1 = np.zeros((n + 1, number_classes + 1), np.int32)
+    mat2 = np.zeros((n + 1, number_classes + 1), np.float64)
+    inf = np.inf
     for i in range(1, number_classes + 1):
         mat1[1][i] = 1
-        mat2[1][i] = 0
-        for j in range(2, len(data_list) + 1):
-            mat2[j][i] = float('inf')
+        mat2[1][i] = 0.0
+        for j in range(2, n + 1):
+            mat2[j][i] = inf
     v = 0.0
-    for l in range(2, len(data_list) + 1):
+    for l in range(2, n + 1):
         s1 = 0.0
         s2 = 0.0
         w = 0.0
         for m in range(1, l + 1):
             i3 = l - m + 1
-            val = float(data_list[i3 - 1])
+            val = data[i3 - 1]
             s2 += val * val
             s1 += val
-            w += 1
+            w += 1.0
             v = s2 - (s1 * s1) / w
             i4 = i3 - 1
             if i4 != 0:
@@ -94,20 +111,69 @@ def get_jenks_breaks(data_list, number_classes):
                         mat2[l][j] = v + mat2[i4][j - 1]
         mat1[l][1] = 1
         mat2[l][1] = v
-    k = len(data_list)
-    kclass = []
+    kclass = np.empty(number_classes + 1, np.float64)
     for i in range(number_classes + 1):
-        kclass.append(min(data_list))
-    kclass[number_classes] = float(data_list[len(data_list) - 1])
+        kclass[i] = data[0]
+    kclass[number_classes] = data[n - 1]
+    k = n
     count_num = number_classes
-    while count_num >= 2:  # print "rank = " + str(mat1[k][count_num])
-        idx = int((mat1[k][count_num]) - 2)
-        # print "val = " + str(data_list[idx])
-        kclass[count_num - 1] = data_list[idx]
-        k = int((mat1[k][count_num] - 1))
+    while count_num >= 2:
+        idx = mat1[k][count_num] - 2
+        kclass[count_num - 1] = data[idx]
+        k = mat1[k][count_num] - 1
         count_num -= 1
     return kclass
 
+
+if njit is not None:
+    _jenks_breaks_impl = njit(cache=True)(_jenks_breaks_impl)
+    # compile once at import time so the first search doesn't pay the JIT cost
+    _jenks_breaks_impl(np.array([0.0, 1.0], np.float64), 1)
+
+
+def _jenks_breaks_numpy(data, number_classes):
+    # same DP as _jenks_breaks_impl, but the inner variance loop is expressed
+    # with prefix sums so every l-iteration runs as vectorized numpy ufuncs
+    n = data.shape[0]
+    c1 = np.concatenate(([0.0], np.cumsum(data)))
+    c2 = np.concatenate(([0.0], np.cumsum(data * data)))
+    mat1 = np.zeros((n + 1, number_classes + 1), np.int32)
+    mat2 = np.zeros((n + 1, number_classes + 1), np.float64)
+    mat1[1, 1:] = 1
+    mat2[2:, 1:] = np.inf
+    for l in range(2, n + 1):
+        # v[i3 - 1] is the variance of data[i3 - 1:l] for i3 = 1..l
+        s1 = c1[l] - c1[:l]
+        s2 = c2[l] - c2[:l]
+        w = np.arange(l, 0, -1, dtype=np.float64)
+        v = s2 - s1 * s1 / w
+        if number_classes >= 2:
+            cand = v[1:, np.newaxis] + mat2[1:l, 1:number_classes]
+            idx = np.argmin(cand, axis=0)
+            mat1[l, 2:] = idx + 2
+            mat2[l, 2:] = cand[idx, np.arange(number_classes - 1)]
+        mat1[l, 1] = 1
+        mat2[l, 1] = v[0]
+    kclass = np.empty(number_classes + 1, np.float64)
+    kclass[:] = data[0]
+    kclass[number_classes] = data[n - 1]
+    k = n
+    count_num = number_classes
+    while count_num >= 2:
+        idx = int(mat1[k, count_num]) - 2
+        kclass[count_num - 1] = data[idx]
+        k = int(mat1[k, count_num]) - 1
+        count_num -= 1
+    return kclass
+
+
+# https://stackoverflow.com/questions/28416408/scikit-learn-how-to-run-kmeans-on-a-one-dimensional-array
+def get_jenks_breaks(data_list, number_classes):
+    data = np.sort(np.asarray(data_list, np.float64))
+    if njit is None:
+        return list(_jenks_breaks_numpy(data, number_classes))
+    return list(_jenks_breaks_impl(data, number_classes))
+
 def get_system_datadir() -> pathlib.Path:
     '''
     Returns a parent directory path